@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+    textpress_importer.admin
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    The import page of the TextPress importer.
+
+    :copyright: Copyright 2009 by Pedro Algarvio.
+    :license: GNU GPL.
+"""
+import os
+import urllib
+from shutil import copyfileobj
+from tempfile import NamedTemporaryFile
+from zine.i18n import _, lazy_gettext
+from zine.utils import log, forms
+from zine.utils.admin import flash
+from zine.utils.http import redirect_to
+from zine.utils.validators import is_valid_url
+from tpxa import parse_feed, parse_feed_file, fetch_attachments, \
+     rewrite_urls, _fetch_checksum
+from validator import validate_feed
+
+
+BUGS_LINK = "http://zine.ufsoft.org/newticket?keywords=textpress_export" + \
+            "&component=Textpress%20Importer"
+
+
+def _download(url):
+    """Download `url` into a temporary file of its own and return the
+    filename.  The caller has to remove the file.
+    """
+    fd = urllib.urlopen(url)
+    try:
+        tmp = NamedTemporaryFile(suffix='.tpxa', delete=False)
+        try:
+            copyfileobj(fd, tmp, 256 * 1024)
+        except:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+        tmp.close()
+        return tmp.name
+    finally:
+        fd.close()
+
+
+class FeedImportForm(forms.Form):
+    """This form is used in the Textpress importer."""
+    download_url = forms.TextField(
+        lazy_gettext(u'Textpress Export File Download URL'),
+        validators=[is_valid_url()])
+    checksum = forms.TextField(
+        lazy_gettext(u'SHA256 Checksum'),
+        help_text=lazy_gettext(u'The checksum written by the exporter. If '
+                               u'empty the checksum file next to the '
+                               u'download URL is used if available.'))
+    fetch_attachments = forms.BooleanField(
+        lazy_gettext(u'Download the attachments linked from the posts'),
+        help_text=lazy_gettext(u'Only suitable for small blogs, use the '
+                               u'batch.py script with --fetch-attachments '
+                               u'for large ones.'))
+    rewrite_urls = forms.BooleanField(
+        lazy_gettext(u'Rewrite links to the old blog in the imported '
+                     u'content'))
+    dry_run = forms.BooleanField(
+        lazy_gettext(u'Only validate the export file, don\'t import it'))
+
+
+def configure(importer, request):
+    """The configuration view of :class:`TextPressFeedImporter`."""
+    form = FeedImportForm()
+
+    if request.method == 'POST' and form.validate(request.form):
+        feed = request.files.get('feed')
+        downloaded = None
+        checksum = form.data['checksum']
+        if form.data['download_url']:
+            if not form.data['download_url'].endswith('.tpxa'):
+                error = _(u"Don't pass a real feed URL, it should be a "
+                          u"regular URL where you're serving the file "
+                          u"generated with the textpress_exporter.py script")
+                flash(error, 'error')
+                return importer.render_admin_page('import_textpress.html',
+                                                  form=form.as_widget(),
+                                                  bugs_link=BUGS_LINK)
+            if not checksum:
+                checksum = _fetch_checksum(form.data['download_url'])
+            # downloads are stored in a temporary file which is then
+            # parsed like any other local file
+            try:
+                feed = downloaded = _download(form.data['download_url'])
+            except Exception, e:
+                error = _(u'Error downloading from URL: %s') % e
+                flash(error, 'error')
+                return importer.render_admin_page('import_textpress.html',
+                                                  form=form.as_widget(),
+                                                  bugs_link=BUGS_LINK)
+        elif not feed:
+            return redirect_to('import/feed')
+
+        try:
+            return _import(importer, form, feed, checksum)
+        finally:
+            if downloaded is not None:
+                os.remove(downloaded)
+
+    return importer.render_admin_page('import_textpress.html',
+                                      form=form.as_widget(),
+                                      bugs_link=BUGS_LINK)
+
+
+def _import(importer, form, feed, checksum):
+    """Validate or import the `feed`, which is either an uploaded file or
+    the name of a downloaded one.
+    """
+    if form.data['dry_run']:
+        try:
+            report = validate_feed(feed, checksum)
+        except Exception, e:
+            log.exception(_(u'Error validating uploaded file'))
+            flash(_(u'Error validating feed: %s') % e, 'error')
+            report = None
+        return importer.render_admin_page('import_textpress.html',
+                                          form=form.as_widget(),
+                                          bugs_link=BUGS_LINK,
+                                          report=report)
+
+    try:
+        if isinstance(feed, basestring):
+            blog = parse_feed_file(feed, checksum)
+        else:
+            blog = parse_feed(feed, checksum)
+    except Exception, e:
+        log.exception(_(u'Error parsing uploaded file'))
+        print repr(e)
+        flash(_(u'Error parsing feed: %s') % e, 'error')
+    else:
+        if form.data['fetch_attachments']:
+            failed = fetch_attachments(importer.app, blog)
+            if failed:
+                flash(_(u'%d attachments could not be downloaded.') %
+                      len(failed), 'error')
+        if form.data['rewrite_urls']:
+            rewrite_urls(importer.app, blog)
+        importer.enqueue_dump(blog)
+        flash(_(u'Added imported items to queue.'))
+        return redirect_to('admin/import')
+
+    return importer.render_admin_page('import_textpress.html',
+                                      form=form.as_widget(),
+                                      bugs_link=BUGS_LINK)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+    textpress_importer.attachments
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Finds the files imported posts link to on the old blog and downloads
+    them into the Zine instance.  The downloads are spread over a bounded
+    number of worker threads and every worker keeps one keep-alive
+    connection per host, so a large number of attachments can be copied
+    without opening a connection for each of them.
+
+    :copyright: Copyright 2009 by Pedro Algarvio.
+    :license: GNU GPL.
+"""
+import os
+import re
+import socket
+import posixpath
+from urllib import unquote
+from hashlib import md5
+from tempfile import mkstemp
+from httplib import HTTPConnection, HTTPSConnection, HTTPException
+from Queue import Queue, Empty
+from threading import Thread, Lock
+from urlparse import urljoin, urlsplit
+
+#: the extensions of the files that are treated as attachments
+ATTACHMENT_EXTENSIONS = frozenset([
+    'png', 'jpg', 'jpeg', 'gif', 'bmp', 'svg', 'ico', 'pdf', 'txt', 'zip',
+    'gz', 'bz2', 'tgz', 'tar', 'rar', '7z', 'doc', 'odt', 'xls', 'ods',
+    'ppt', 'odp', 'mp3', 'ogg', 'avi', 'mpg', 'mp4', 'mov', 'flv', 'swf',
+    'py', 'diff', 'patch'
+])
+
+_link_re = re.compile(r'''\b(?:src|href)\s*=\s*(["'])(.*?)\1''', re.I)
+
+
+def _is_attachment(path):
+    extension = posixpath.splitext(path)[1][1:].lower()
+    return extension in ATTACHMENT_EXTENSIONS
+
+
+def find_attachments(blog):
+    """Return the set of attachment URLs on the blog's own site that the
+    bodies and intros of the imported posts link to.  Relative links are
+    resolved against the post's URL, which is the ``xml:base`` of its entry.
+    """
+    netloc = urlsplit(blog.link or '')[1]
+    rv = set()
+    for post in blog.posts:
+        base = post.link or blog.link
+        for text in post.body, post.intro:
+            if not text:
+                continue
+            for match in _link_re.finditer(text):
+                url = urljoin(base, match.group(2).strip()).split('#', 1)[0]
+                scheme, host, path = urlsplit(url)[:3]
+                if scheme in ('http', 'https') and host == netloc and \
+                   _is_attachment(path):
+                    rv.add(url)
+    return rv
+
+
+def attachment_filename(url):
+    """The path relative to the attachment folder a URL is stored at.  If
+    the URL has a query string a hash of it is added to the filename.
+    The path is percent-decoded, so the file has the name a web server
+    would map the URL to.  Returns `None` if no safe filename can be
+    derived from the URL.
+    """
+    path, query = urlsplit(url)[2:4]
+    path = posixpath.normpath('/' + unquote(path)).lstrip('/')
+    if not path or path.startswith('..') or '\0' in path or \
+       '\\' in path:
+        return None
+    if query:
+        base, ext = posixpath.splitext(path)
+        path = '%s-%s%s' % (base, md5(query).hexdigest()[:8], ext)
+    return path
+
+
+def _make_connection(scheme, netloc, timeout):
+    if scheme == 'https':
+        return HTTPSConnection(netloc, timeout=timeout)
+    return HTTPConnection(netloc, timeout=timeout)
+
+
+class AttachmentFetcher(object):
+    """Downloads attachments into `folder` with `workers` threads.  The
+    `connection_factory` is called with the scheme, the host and the
+    timeout and has to return an :class:`httplib.HTTPConnection` like
+    object; it defaults to plain httplib connections.
+    """
+
+    def __init__(self, folder, workers=8, timeout=30,
+                 connection_factory=_make_connection):
+        self.folder = folder
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.connection_factory = connection_factory
+        self.fetched = {}
+        self.failed = {}
+        self._reserved = set()
+        self._lock = Lock()
+
+    def fetch(self, urls):
+        """Download all `urls` and return a dict of the URLs that were
+        fetched mapped to the filenames relative to the folder.  Failed
+        downloads are recorded in `failed` with the error.
+        """
+        queue = Queue()
+        for url in sorted(set(urls)):
+            if url not in self.fetched:
+                queue.put(url)
+        threads = [Thread(target=self._work, args=(queue,))
+                   for x in xrange(min(self.workers, queue.qsize()))]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.fetched
+
+    def _work(self, queue):
+        connections = {}
+        try:
+            while 1:
+                try:
+                    url = queue.get_nowait()
+                except Empty:
+                    break
+                try:
+                    self.fetched[url] = self._fetch(url, connections)
+                except Exception, e:
+                    self.failed[url] = str(e) or e.__class__.__name__
+                    # don't reuse a connection in an unknown state
+                    connection = connections.pop(tuple(urlsplit(url)[:2]),
+                                                 None)
+                    if connection is not None:
+                        connection.close()
+        finally:
+            for connection in connections.itervalues():
+                connection.close()
+
+    def _fetch(self, url, connections):
+        filename = attachment_filename(url)
+        if filename is None:
+            raise ValueError('no filename for the attachment')
+        scheme, netloc, path, query = urlsplit(url)[:4]
+        if query:
+            path += '?' + query
+
+        # a keep-alive connection may have been closed by the server in
+        # the meantime, in that case retry once on a fresh connection.
+        for attempt in 0, 1:
+            connection = connections.get((scheme, netloc))
+            if connection is None:
+                connection = connections[scheme, netloc] = \
+                    self.connection_factory(scheme, netloc, self.timeout)
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                break
+            except (HTTPException, socket.error):
+                connection.close()
+                del connections[scheme, netloc]
+                if attempt:
+                    raise
+
+        if response.status != 200:
+            response.read()
+            raise IOError('HTTP status %d' % response.status)
+
+        directory = os.path.dirname(self._path(filename))
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+        # download into a temporary file first so that a failed download
+        # does not leave a truncated attachment behind.
+        fd, tmp = mkstemp(prefix='.', suffix='.part', dir=directory)
+        try:
+            fd = os.fdopen(fd, 'wb')
+            try:
+                while 1:
+                    chunk = response.read(64 * 1024)
+                    if not chunk:
+                        break
+                    fd.write(chunk)
+            finally:
+                fd.close()
+            filename = self._reserve(filename)
+            os.rename(tmp, self._path(filename))
+        except:
+            os.remove(tmp)
+            raise
+        return filename
+
+    def _path(self, filename):
+        return os.path.join(self.folder, *filename.split('/'))
+
+    def _reserve(self, filename):
+        """Return a filename based on `filename` that neither exists in the
+        folder nor is used by another download.
+        """
+        base, ext = posixpath.splitext(filename)
+        self._lock.acquire()
+        try:
+            counter = 0
+            while filename in self._reserved or \
+                  os.path.exists(self._path(filename)):
+                counter += 1
+                filename = '%s-%d%s' % (base, counter, ext)
+            self._reserved.add(filename)
+        finally:
+            self._lock.release()
+        return filename
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    textpress_importer.batch
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Imports a number of TPXA exports into one Zine instance.  The exports
+    are parsed concurrently in a pool of processes and the parsed blogs are
+    added to the import queue of the instance one after another.  The
+    instance must have this plugin enabled::
+
+        python batch.py -i /path/to/instance a.tpxa http://host/b.tpxa
+
+    :copyright: Copyright 2009 by Pedro Algarvio.
+    :license: GNU GPL.
+"""
+import urllib
+from os.path import exists
+from time import time
+from cPickle import dumps, loads
+
+
+def _is_url(source):
+    return source.startswith('http://') or source.startswith('https://')
+
+
+def _setup(instance_folder):
+    """Create the Zine application for `instance_folder`."""
+    from zine import setup
+    return setup(instance_folder)
+
+
+def _load(source):
+    """Parse the export from `source`, a filename or an URL.  The checksum
+    next to the export is verified if there is one.
+    """
+    from zine.plugins.textpress_importer.tpxa import parse_feed, \
+         parse_feed_file, _fetch_checksum
+    if not _is_url(source):
+        checksum = None
+        if exists(source + '.sha256'):
+            fd = open(source + '.sha256')
+            try:
+                checksum = fd.read()
+            finally:
+                fd.close()
+        return parse_feed_file(source, checksum)
+    checksum = _fetch_checksum(source)
+    fd = urllib.urlopen(source)
+    try:
+        return parse_feed(fd, checksum)
+    finally:
+        fd.close()
+
+
+def _parse(source):
+    """Runs in the worker processes.  Returns the source, the pickled blog
+    or `None` if the blog can't be pickled, an error message if parsing
+    failed and the time it took.
+    """
+    start = time()
+    try:
+        blog = _load(source)
+    except Exception, e:
+        return source, None, str(e) or e.__class__.__name__, time() - start
+    # the parsed XML is only needed while parsing and lxml elements can't
+    # be pickled
+    blog.element = None
+    for post in blog.posts:
+        post.element = None
+    try:
+        blog = dumps(blog, 2)
+    except Exception:
+        blog = None
+    return source, blog, None, time() - start
+
+
+class BlogSummary(object):
+    """The result of the import of one export."""
+
+    def __init__(self, source, parse_time, error=None):
+        self.source = source
+        self.parse_time = parse_time
+        self.enqueue_time = 0.0
+        self.error = error
+        self.reparsed = False
+        self.failed_attachments = 0
+        self.posts = self.comments = self.authors = 0
+
+    def __str__(self):
+        if self.error is not None:
+            return '%s: failed after %.1fs: %s' % (self.source,
+                                                   self.parse_time,
+                                                   self.error)
+        rv = '%s: %d posts, %d comments, %d authors; parsed in %.1fs, ' \
+             'queued in %.1fs' % (self.source, self.posts, self.comments,
+                                   self.authors, self.parse_time,
+                                   self.enqueue_time)
+        if self.failed_attachments:
+            rv += '; %d attachments could not be downloaded' % \
+                  self.failed_attachments
+        if self.reparsed:
+            rv += ' (not picklable, parsed again in the main process)'
+        return rv
+
+
+def import_blogs(app, instance_folder, sources, processes=None,
+                 fetch_attachments=False, rewrite_urls=False):
+    """Parse the exports from `sources` in a pool of `processes` workers
+    and add them to the import queue of `app` one after another.  Yields a
+    :class:`BlogSummary` for every export as soon as it is queued.
+    """
+    from multiprocessing import Pool
+    from zine.plugins.textpress_importer import TextPressFeedImporter, tpxa
+
+    importer = TextPressFeedImporter(app)
+    pool = Pool(processes, _setup, (instance_folder,))
+    try:
+        for source, blog, error, parse_time in \
+                pool.imap_unordered(_parse, sources):
+            summary = BlogSummary(source, parse_time, error)
+            if error is None:
+                start = time()
+                try:
+                    if blog is None:
+                        # the worker could not send the blog back
+                        summary.reparsed = True
+                        blog = _load(source)
+                        summary.parse_time += time() - start
+                        start = time()
+                    else:
+                        blog = loads(blog)
+                    if fetch_attachments:
+                        summary.failed_attachments = \
+                            len(tpxa.fetch_attachments(app, blog))
+                    if rewrite_urls:
+                        tpxa.rewrite_urls(app, blog)
+                    importer.enqueue_dump(blog)
+                except Exception, e:
+                    summary.error = str(e) or e.__class__.__name__
+                else:
+                    summary.posts = len(blog.posts)
+                    summary.comments = sum(len(post.comments)
+                                           for post in blog.posts)
+                    summary.authors = len(blog.authors)
+                summary.enqueue_time = time() - start
+            yield summary
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog -i INSTANCE [options] '
+                                'export.tpxa|URL [...]')
+    parser.add_option(
+        '--instance', '-i', help="Path to the Zine instance folder")
+    parser.add_option(
+        '--processes', '-p', type='int', default=None,
+        help="Number of processes parsing exports. (number of CPUs)")
+    parser.add_option(
+        '--fetch-attachments', '-a', default=False, action='store_true',
+        help="Download the attachments linked from the posts. (%default)")
+    parser.add_option(
+        '--rewrite-urls', '-r', default=False, action='store_true',
+        help="Rewrite links to the old blogs in the imported content. "
+             "(%default)")
+
+    options, args = parser.parse_args()
+    if not options.instance:
+        parser.print_help()
+        parser.error("you need to pass the path to your instance folder")
+    elif not args:
+        parser.error("you need to pass at least one export file or URL")
+    elif options.processes is not None and options.processes <= 0:
+        parser.error("--processes must be a positive number")
+
+    app = _setup(options.instance)
+    start = time()
+    failed = 0
+    for summary in import_blogs(app, options.instance, args,
+                                options.processes, options.fetch_attachments,
+                                options.rewrite_urls):
+        print summary
+        failed += summary.error is not None
+    print "Imported %d of %d exports in %.1fs" % (len(args) - failed,
+                                                   len(args), time() - start)
+    raise SystemExit(failed and 1 or 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+    textpress_importer.integrity
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Helpers to verify that a TPXA file was transferred completely.  The
+    exporter can write a sha256 checksum of the export into a sidecar file
+    and this module checks it while the file is streamed into the parser,
+    so no second pass over the file is required.
+
+    This module only depends on the standard library so that it can be
+    used by the command line tools without a Zine instance.
+
+    :copyright: Copyright 2009 by Pedro Algarvio.
+    :license: GNU GPL.
+"""
+import re
+import os
+import mmap
+from hashlib import sha256
+
+_checksum_re = re.compile(r'^([0-9a-fA-F]{64})(?:\s+\*?.*)?$')
+
+
+class IntegrityError(Exception):
+    """Raised if an export file does not match its checksum or trailer."""
+
+
+def read_checksum(value):
+    """Return the hex digest from a checksum as written by the exporter.
+    Both the plain digest and the ``sha256sum`` format are accepted.
+    """
+    value = (value or '').strip()
+    match = _checksum_re.match(value.splitlines()[0] if value else '')
+    if match is None:
+        raise IntegrityError('invalid sha256 checksum %r' % value[:80])
+    return match.group(1).lower()
+
+
+class MappedFile(object):
+    """A read-only file object over a memory mapping of a local file.  It
+    can be handed to the parser directly or wrapped in a
+    :class:`ChecksumReader`, so the file is hashed while it is parsed.
+    """
+
+    def __init__(self, filename):
+        fd = open(filename, 'rb')
+        try:
+            self._size = os.fstat(fd.fileno()).st_size
+            self._mapping = None
+            if self._size:
+                self._mapping = mmap.mmap(fd.fileno(), 0,
+                                          access=mmap.ACCESS_READ)
+        finally:
+            fd.close()
+
+    def read(self, size=-1):
+        if self._mapping is None:
+            return ''
+        if size < 0:
+            size = self._size - self._mapping.tell()
+        return self._mapping.read(size)
+
+    def close(self):
+        if self._mapping is not None:
+            self._mapping.close()
+            self._mapping = None
+
+
+class ChecksumReader(object):
+    """Wraps a file object and hashes everything that is read from it.
+    Once the end of the file is reached the digest is compared to the
+    expected one and an :exc:`IntegrityError` is raised on mismatch,
+    before the consumer gets to see the end of the stream.
+    """
+
+    def __init__(self, fd, checksum):
+        self._fd = fd
+        self._expected = read_checksum(checksum)
+        self._hash = sha256()
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self._fd.read(size)
+        if data:
+            self._hash.update(data)
+            self.bytes_read += len(data)
+        else:
+            self.verify()
+        return data
+
+    def verify(self):
+        digest = self._hash.hexdigest()
+        if digest != self._expected:
+            raise IntegrityError('checksum mismatch after %d bytes: expected '
+                                 '%s, got %s' % (self.bytes_read,
+                                                 self._expected, digest))
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+    textpress_importer.rewrite
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Rewrites the links to the old blog in the imported content.  All the
+    old URLs are compiled into one regular expression shaped like a trie of
+    the URLs, so every text is rewritten in a single pass no matter how
+    many URLs are mapped.
+
+    :copyright: Copyright 2009 by Pedro Algarvio.
+    :license: GNU GPL.
+"""
+import re
+from urlparse import urlsplit
+
+# a URL must not continue after the match, otherwise "/foo" would be
+# rewritten inside of "/foobar".  A dot is fine as long as it ends a
+# sentence.
+_url_end = r'(?![\w\-~%+/]|\.\w)'
+
+# characters that may precede a host relative URL in markup
+_path_prefixes = frozenset('"\'=(')
+
+
+def _trie_pattern(words):
+    """Return a regular expression that matches any of `words`, preferring
+    the longest match.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = None
+    return _node_pattern(trie)
+
+
+def _node_pattern(node):
+    branches = [re.escape(char) + _node_pattern(child)
+                for char, child in sorted(node.iteritems()) if char]
+    if not branches:
+        return ''
+    if len(branches) == 1 and '' not in node:
+        return branches[0]
+    rv = '(?:%s)' % '|'.join(branches)
+    if '' in node:
+        rv += '?'
+    return rv
+
+
+class URLRewriter(object):
+    """Replaces the URLs in `mapping` by the URLs they are mapped to.  For
+    URLs on the old blog's host (`old_netloc`) the host relative form is
+    rewritten too, if it is used as attribute value.
+    """
+
+    def __init__(self, mapping, old_netloc=None):
+        self.mapping = dict(mapping)
+        for url, new_url in mapping.iteritems():
+            scheme, netloc, path, query = urlsplit(url)[:4]
+            if netloc == old_netloc and len(path) > 1:
+                if query:
+                    path += '?' + query
+                self.mapping.setdefault(path, new_url)
+        self._regex = None
+        if self.mapping:
+            self._regex = re.compile(_trie_pattern(self.mapping) + _url_end)
+
+    def _replace(self, match):
+        url = match.group()
+        if url[0] == '/':
+            start = match.start()
+            if not start or match.string[start - 1] not in _path_prefixes:
+                return url
+        return self.mapping[url]
+
+    def rewrite(self, text):
+        """Return `text` with all the known URLs rewritten."""
+        if not text or self._regex is None:
+            return text
+        return self._regex.sub(self._replace, text)
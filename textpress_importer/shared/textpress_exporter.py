@@ -25,9 +25,11 @@
 from cPickle import dumps
 from datetime import datetime
 from itertools import chain
+from hashlib import sha256
 
 from textpress import __version__
 from textpress.api import *
+from textpress.api import db
 from textpress.models import Post, User
 try:
     from textpress.utils import build_tag_uri
@@ -87,6 +89,12 @@ XML_PREAMBLE = u'''\
 <a:updated>%(updated)s</a:updated>'''
 XML_EPILOG = '</a:feed>'
 
+#: the default size of the blocks written to the export file
+DEFAULT_BLOCK_SIZE = 256 * 1024
+
+#: the default number of posts loaded from the database at once
+DEFAULT_BATCH_SIZE = 200
+
 def format_iso8601(obj):
     return obj.strftime('%Y-%m-%dT%H:%M:%SZ')
 
@@ -107,6 +115,52 @@ class _MinimalO(object):
         return rv
 
 
+class _BlockWriter(object):
+    """Coalesces the fragments generated by the writer into blocks of
+    `block_size` bytes before handing them to the underlying file so that
+    the export is written with few, large sequential writes.  If `checksum`
+    is enabled a sha256 hash of the stream is computed on the way.
+    """
+
+    def __init__(self, fd, block_size=DEFAULT_BLOCK_SIZE, checksum=False):
+        self._fd = fd
+        self._block_size = block_size
+        self._buffer = []
+        self._buffered = 0
+        self._hash = checksum and sha256() or None
+        self.bytes_written = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self._block_size:
+            self._flush(aligned=True)
+
+    def _flush(self, aligned=False):
+        data = ''.join(self._buffer)
+        cut = len(data)
+        if aligned:
+            cut -= cut % self._block_size
+        if cut:
+            chunk = data[:cut]
+            if self._hash is not None:
+                self._hash.update(chunk)
+            self._fd.write(chunk)
+            self.bytes_written += cut
+        rest = data[cut:]
+        self._buffer = rest and [rest] or []
+        self._buffered = len(rest)
+
+    def close(self):
+        """Write out what is left in the buffer and return the hex digest
+        of the stream or `None` if no checksum was requested.
+        """
+        self._flush()
+        self._fd.flush()
+        if self._hash is not None:
+            return self._hash.hexdigest()
+
+
 class _ElementHelper(object):
 
     def __init__(self, etree, ns):
@@ -151,8 +205,10 @@ class Participant(object):
 class Writer(object):
 
     def __init__(self, app, description_to_category=True,
-                 tags_to_categories=False, keep_as_tags=()):
+                 tags_to_categories=False, keep_as_tags=(),
+                 batch_size=DEFAULT_BATCH_SIZE):
         self.app = app
+        self.batch_size = batch_size
         self.description_to_category = description_to_category
         self.tags_to_categories = tags_to_categories
         self.keep_as_tags = keep_as_tags
@@ -165,26 +221,68 @@ class Writer(object):
         self.participants = [x(self) for x in
                              emit_event('get-tpxa-participants') if x]
 
+    def _iter_batches(self, query, columns, descending=False):
+        """Iterate over all the rows of `query` ordered by `columns`.  The
+        rows are loaded in batches of `batch_size` using the values of the
+        last row of the previous batch as lower bound, so that no database
+        cursor stays open for the whole export.  Once the next batch is
+        requested the rows of the previous one are removed from the session
+        and the transaction is rolled back, so that the database doesn't
+        have to keep one snapshot alive for the whole export.  The export
+        never writes, so nothing is lost by the rollback.
+        """
+        names = [column.key for column in columns]
+        if descending:
+            query = query.order_by(*[column.desc() for column in columns])
+        else:
+            query = query.order_by(*[column.asc() for column in columns])
+        last = None
+        while 1:
+            batch_query = query
+            if last is not None:
+                clauses = []
+                for idx, column in enumerate(columns):
+                    clause = [c == value for c, value
+                              in zip(columns[:idx], last[:idx])]
+                    if descending:
+                        clause.append(column < last[idx])
+                    else:
+                        clause.append(column > last[idx])
+                    clauses.append(db.and_(*clause))
+                batch_query = query.filter(db.or_(*clauses))
+            batch = batch_query.limit(self.batch_size).all()
+            if not batch:
+                break
+            for row in batch:
+                yield row
+            last = [getattr(batch[-1], name) for name in names]
+            for row in batch:
+                for comment in getattr(row, 'comments', ()):
+                    db.session.expunge(comment)
+                db.session.expunge(row)
+            db.session.rollback()
+
     def _generate(self):
         now = datetime.utcnow()
-        posts = iter(Post.objects.order_by(Post.last_update.desc()))
+        posts = self._iter_batches(Post.objects, [Post.last_update,
+                                                  Post.post_id], True)
+        pages = iter(())
         if 'pages' in self.app.plugins:
             try:
                 from textpress.plugins import pages as textpress_pages
-                pages = iter(textpress_pages.Page.objects.all())
+                Page = textpress_pages.Page
+                pages = self._iter_batches(Page.objects, [Page.page_id])
+                # load the first batch now so that a failing query ends up
+                # here and not in the middle of the export
+                pages = chain((pages.next(),), pages)
             except:
-                # Last resort
+                # Last resort, or no pages at all
                 pages = iter(())
 
-        try:
-            first_post = posts.next()
-            first_page = pages.next()
-            last_update = first_post.last_update
-            posts = chain((first_post,), posts)
-            pages = chain((first_page,), pages)
-        except StopIteration:
-            first_post = None
-            first_page = None
+        latest_post = Post.objects.order_by(Post.last_update.desc()).first()
+        if latest_post is not None:
+            last_update = latest_post.last_update
+        else:
             last_update = now
 
         feed_id = build_tag_uri(self.app, last_update, 'tpxa_export', 'full')
@@ -226,12 +324,15 @@ class Writer(object):
             self._register_user(user)
 
         # dump all the posts
+        entries = 0
         for post in posts:
             yield dump_node(self._dump_post(post))
+            entries += 1
 
         # dump all the pages
         for page in pages:
             yield dump_node(self._dump_page(page))
+            entries += 1
 
         # if we have dependencies (very likely) dump them now
         if self._dependencies:
@@ -240,6 +341,9 @@ class Writer(object):
                 yield dump_node(node)
             yield '</tp:dependencies>'
 
+        # the trailer allows the importer to detect truncated exports
+        yield dump_node(self.tp('trailer', entries=str(entries)))
+
         yield XML_EPILOG.encode('utf-8')
 
     def new_dependency(self, tag):
@@ -398,6 +502,17 @@ def main():
         help="keep the passed string has a tag no matter if the above flags "
               "are user or not. Pass multiple '--keep-as-tag/-k' for multiple "
               "tags.")
+    parser.add_option(
+        '--block-size', '-b', type='int', default=DEFAULT_BLOCK_SIZE,
+        help="Size in bytes of the blocks written to the export file. "
+             "(%default)")
+    parser.add_option(
+        '--batch-size', '-s', type='int', default=DEFAULT_BATCH_SIZE,
+        help="Number of posts loaded from the database at once. (%default)")
+    parser.add_option(
+        '--checksum', '-c', default=False, action='store_true',
+        help="Compute a sha256 checksum of the export and write it to a "
+             "'.sha256' file next to it. (%default)")
 
     options, args = parser.parse_args()
     if not options.instance:
@@ -406,6 +521,10 @@ def main():
     elif options.tags_to_categories and options.with_descriptions_to_categories:
         parser.error("you can only pass one of --tags-to-categories/"
                      "--with-descriptions-to-categories")
+    elif options.block_size <= 0:
+        parser.error("--block-size must be a positive number of bytes")
+    elif options.batch_size <= 0:
+        parser.error("--batch-size must be a positive number of posts")
 
     instance_folder = options.instance
     print "Exporting from %s to" % instance_folder,
@@ -416,12 +535,27 @@ def main():
                                                         or 'blog_export.tpxa'
 
     print export_filename
-    export_file = open(export_filename, 'w')
+    export_file = open(export_filename, 'wb')
 
     exporter = Writer(application, options.with_descriptions_to_categories,
-                      options.tags_to_categories, options.keep_as_tag)
-    for entry in exporter._generate():
-        export_file.write(entry)
+                      options.tags_to_categories, options.keep_as_tag,
+                      options.batch_size)
+    out = _BlockWriter(export_file, options.block_size, options.checksum)
+    try:
+        for entry in exporter._generate():
+            out.write(entry)
+        checksum = out.close()
+    finally:
+        export_file.close()
+
+    if checksum is not None:
+        checksum_file = open(export_filename + '.sha256', 'w')
+        try:
+            # same format as the output of the sha256sum utility
+            checksum_file.write('%s  %s\n' % (checksum, export_filename))
+        finally:
+            checksum_file.close()
+        print "Checksum written to %s.sha256" % export_filename
 
 if __name__ == '__main__':
     main()
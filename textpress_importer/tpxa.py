@@ -0,0 +1,698 @@
+# -*- coding: utf-8 -*-
+"""
+    textpress_importer.tpxa
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    The parser for TPXA files and the import stages that work on the
+    parsed blog.  This module is only imported once an import actually
+    runs, see :func:`textpress_importer.setup`.
+
+    :copyright: (c) 2008 by the Zine Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+import urllib
+from urlparse import urlsplit
+from pickle import loads
+from lxml import etree
+from os.path import join
+from zine.application import get_application
+from zine.i18n import _
+from zine.importers import Blog, Tag, Category, Author, Post, Comment
+from zine.importers.feed import Extension
+try:
+    from zine.importers.feed import ZEAExtension
+except ImportError:
+    ZEAExtension = None
+from zine.utils.dates import parse_iso8601
+from zine.utils.xml import Namespace, to_text
+from zine.utils.zeml import load_parser_data
+from zine.utils.exceptions import UserException
+from zine.zxa import ATOM_NS, XML_NS
+from integrity import ChecksumReader, IntegrityError, MappedFile, \
+     read_checksum
+from attachments import AttachmentFetcher, find_attachments
+from rewrite import URLRewriter
+
+TEXTPRESS_NS = 'http://textpress.pocoo.org/'
+TEXTPRESS_TAG_URI = TEXTPRESS_NS + '#tag-scheme'
+TEXTPRESS_CATEGORY_URI = TEXTPRESS_NS + '#category-scheme'
+
+atom = Namespace(ATOM_NS)
+xml = Namespace(XML_NS)
+textpress = Namespace(TEXTPRESS_NS)
+
+
+def _get_text_content(elements):
+    """Return the text content from the best element match."""
+    if not elements:
+        return u''
+    for element in elements:
+        if element.attrib.get('type') == 'text':
+            return element.text or u''
+    for element in elements:
+        if element.attrib.get('type') == 'html':
+            return to_text(element)
+    return to_text(elements[0])
+
+
+def _get_html_content(elements):
+    """Returns the html content from the best element match or another
+    content treated as html.  This is totally against the specification
+    but this importer assumes that the text representation is unprocessed
+    markup language from the blog.  This is most likely a dialect of HTML
+    or a lightweight markup language in which case the importer only has
+    to switch the parser afterwards.
+    """
+    if not elements:
+        return u''
+    for element in elements:
+        if element.attrib.get('type') == 'html':
+            return element.text
+    return elements[0].text
+
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    value = value.strip()
+    if value == 'yes':
+        return True
+    elif value == 'no':
+        return False
+    raise ValueError('invalid boolean literal, expected yes/no')
+
+
+def _collect_children(element):
+    """Group the children of `element` by tag in a single pass so that
+    the fields of entries and comments don't require one scan each.
+    """
+    rv = {}
+    for child in element:
+        if child.tag in rv:
+            rv[child.tag].append(child)
+        else:
+            rv[child.tag] = [child]
+    return rv
+
+
+def _findtext(children, tag):
+    """Works like `findtext` on a dict from :func:`_collect_children`."""
+    elements = children.get(tag)
+    if elements:
+        return elements[0].text or ''
+
+
+def _pickle(value):
+    if value:
+        return loads(value.decode('base64'))
+
+
+def _parser_data(value):
+    if value:
+        return load_parser_data(value.decode('base64'))
+
+
+class EntryRecord(object):
+    """The data of an ``<entry>`` element extensions are interested in.
+    It's stored as `record` on the imported post so that the element itself
+    can be released once the post is parsed.
+    """
+    __slots__ = ('content_type', 'categories', 'comments')
+
+    def __init__(self, content_type, categories, comments):
+        self.content_type = content_type
+        self.categories = categories
+        self.comments = comments
+
+
+class CommentRecord(object):
+    """The data of a ``<tp:comment>`` element."""
+    __slots__ = ('id', 'parent', 'author', 'email', 'www', 'dependency',
+                 'published', 'submitter_ip', 'is_pingback', 'status',
+                 'blocked_msg', 'data', 'parser_data')
+
+    def __init__(self, element):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        fields = _comment_fields
+        for child in element:
+            if child.tag == _author_tag:
+                self.dependency = child.attrib.get('dependency')
+                self._set_fields(child, _comment_author_fields)
+            else:
+                name = fields.get(child.tag)
+                if name is not None and getattr(self, name) is None:
+                    setattr(self, name, child.text or '')
+        self.id = int(self.id)
+        self.parent = self.parent and int(self.parent) or None
+
+    def _set_fields(self, element, fields):
+        for child in element:
+            name = fields.get(child.tag)
+            if name is not None and getattr(self, name) is None:
+                setattr(self, name, child.text or '')
+
+
+# mapping of the comment child elements to the record slots
+_author_tag = textpress.author
+_comment_fields = dict((getattr(textpress, name), name) for name in (
+    'id', 'parent', 'published', 'submitter_ip', 'is_pingback', 'status',
+    'blocked_msg', 'data', 'parser_data'))
+_comment_author_fields = {
+    textpress.name:     'author',
+    textpress.email:    'email',
+    textpress.uri:      'www'
+}
+
+
+def parse_feed(fd, checksum=None):
+    """Parse the feed from `fd`.  If a sha256 `checksum` is given it's
+    verified while the file is read into the parser.
+    """
+    if checksum:
+        try:
+            fd = ChecksumReader(fd, checksum)
+        except IntegrityError, e:
+            raise FeedImportError(_(u'Invalid checksum: %s') % e)
+    try:
+        tree = etree.parse(fd).getroot()
+    except IntegrityError, e:
+        raise FeedImportError(_(u'The export file is corrupted or '
+                                u'incomplete: %s') % e)
+    return _parse_tree(tree)
+
+
+def parse_feed_file(filename, checksum=None):
+    """Parse the feed from a local file.  Without a checksum lxml reads the
+    file itself, otherwise the parser is fed from a memory mapping of the
+    file and the checksum is verified on the same read.
+    """
+    if not checksum:
+        return _parse_tree(etree.parse(filename).getroot())
+    fd = MappedFile(filename)
+    try:
+        return parse_feed(fd, checksum)
+    finally:
+        fd.close()
+
+
+def _parse_tree(tree):
+    if tree.tag == 'rss':
+        parser_class = RSSParser
+    elif tree.tag == atom.feed:
+        parser_class = AtomParser
+    else:
+        raise FeedImportError(_('Unknown feed uploaded.'))
+    _check_trailer(tree)
+    parser = parser_class(tree)
+    parser.parse()
+    return parser.blog
+
+
+def _check_trailer(tree):
+    """Compare the number of entries with the trailer written by newer
+    versions of the exporter.  Exports without a trailer are accepted.
+    """
+    trailer = tree.find(textpress.trailer)
+    if trailer is None:
+        return
+    expected = int(trailer.attrib.get('entries', 0))
+    found = len(tree.findall(atom.entry))
+    if found != expected:
+        raise FeedImportError(_(u'The export file is incomplete: expected '
+                                u'%(expected)d entries but found '
+                                u'%(found)d.') % {'expected': expected,
+                                                  'found': found})
+
+
+def _fetch_checksum(url):
+    """Try to download the checksum file the exporter places next to the
+    export.  Returns `None` if there is none or if the response doesn't
+    look like a checksum, e.g. an error page served with status 200.
+    """
+    try:
+        fd = urllib.urlopen(url + '.sha256')
+    except IOError:
+        return None
+    try:
+        if fd.getcode() not in (None, 200):
+            return None
+        checksum = fd.read(4096)
+    finally:
+        fd.close()
+    try:
+        return read_checksum(checksum)
+    except IntegrityError:
+        return None
+
+
+def fetch_attachments(app, blog):
+    """Download the attachments the imported posts link to into the
+    attachment folder of the instance.  The fetched URLs are stored as
+    `attachments` on the blog, mapped to the filenames in that folder.
+    Returns a dict with the URLs that could not be downloaded.
+    """
+    folder = app.cfg['textpress_importer/attachments_folder'] or \
+             join(app.instance_folder, 'uploads')
+    fetcher = AttachmentFetcher(folder,
+                                app.cfg['textpress_importer/attachment_workers'])
+    blog.attachments = fetcher.fetch(find_attachments(blog))
+    return fetcher.failed
+
+
+def _url(base, *parts):
+    return '/'.join([base.rstrip('/')] + [part.strip('/') for part in parts])
+
+
+def _cfg(app, key, default):
+    try:
+        return app.cfg[key] or default
+    except KeyError:
+        return default
+
+
+def build_url_map(app, blog):
+    """Map the URLs of the posts, pages, tags and categories on the old
+    blog and those of the downloaded attachments to their new URLs.
+    """
+    old_url = blog.link or ''
+    new_url = app.cfg['blog_url']
+    tags_prefix = _cfg(app, 'tags_url_prefix', 'tags')
+    categories_prefix = _cfg(app, 'category_url_prefix', 'categories')
+    rv = {}
+    # the extension keeps its tags and categories to itself, so collect
+    # them from the posts.  TextPress only knew tags, that's where both
+    # are linked to on the old blog.
+    for post in blog.posts:
+        if post.link and post.slug:
+            rv[post.link] = _url(new_url, post.slug)
+        for tag in post.tags:
+            rv[_url(old_url, 'tags', tag.slug)] = \
+                _url(new_url, tags_prefix, tag.slug)
+        for category in post.categories:
+            rv[_url(old_url, 'tags', category.slug)] = \
+                _url(new_url, categories_prefix, category.slug)
+    # attachments are only rewritten if the folder is served somewhere
+    attachments_url = app.cfg['textpress_importer/attachments_url']
+    if attachments_url:
+        for url, filename in getattr(blog, 'attachments', {}).iteritems():
+            rv[url] = _url(attachments_url, urllib.quote(filename))
+    return rv
+
+
+def rewrite_urls(app, blog):
+    """Rewrite the links to the old blog in the bodies and intros of the
+    posts and in the comments.
+    """
+    rewriter = URLRewriter(build_url_map(app, blog),
+                           urlsplit(blog.link or '')[1])
+    for post in blog.posts:
+        post.body = rewriter.rewrite(post.body)
+        post.intro = rewriter.rewrite(post.intro)
+        for comment in post.comments:
+            comment.body = rewriter.rewrite(comment.body)
+
+
+class TPParser(object):
+    feed_type = None
+
+    def __init__(self, tree):
+        self.app = get_application()
+        self.tree = tree
+        self.tags = []
+        self.categories = []
+        self.authors = []
+        self.posts = []
+        self.blog = None
+        # Zine's own extension only handles the Zine namespace which never
+        # shows up in TPXA files, the TextPress namespace is handled by
+        # the TPZEAExtension.
+        self.extensions = [extension(self.app, self, tree)
+                           for extension in self.app.feed_importer_extensions
+                           if self.feed_type in extension.feed_types and
+                              extension is not ZEAExtension]
+        # entry elements can only be released if every extension declares
+        # that it works on the records, extensions that don't know about
+        # the records reach the entry through `post.element`.
+        self.keep_elements = not all(getattr(e, 'needs_element', True)
+                                     is False for e in self.extensions)
+
+    def find_tag(self, **critereon):
+        return self._find_criteron(self.tags, critereon)
+
+    def find_category(self, **critereon):
+        return self._find_criteron(self.categories, critereon)
+
+    def find_author(self, **critereon):
+        return self._find_criteron(self.authors, critereon)
+
+    def find_post(self, **critereon):
+        return self._find_criteron(self.posts, critereon)
+
+    def _find_criteron(self, sequence, d):
+        if len(d) != 1:
+            raise TypeError('one critereon expected')
+        key, value = d.iteritems().next()
+        for item in sequence:
+            if getattr(item, key, None) == value:
+                return item
+
+
+class RSSParser(TPParser):
+    feed_type = 'rss'
+
+    def __init__(self, tree):
+        raise FeedImportError(_('Importing of RSS feeds is currently '
+                                'not possible.'))
+
+
+class AtomParser(TPParser):
+    feed_type = 'atom'
+
+    def __init__(self, tree):
+        TPParser.__init__(self, tree)
+
+        # use for the category fallback handling if no extension
+        # takes over the handling.
+        self._categories_by_term = {}
+
+        # and the same for authors
+        self._authors_by_username = {}
+        self._authors_by_email = {}
+
+    def parse(self):
+        for entry in self.tree.findall(atom.entry):
+            self.posts.append(self.parse_post(entry))
+
+        link = self.tree.find(atom.link)
+        if link is not None:
+            link = link.attrib.get('href')
+
+        self.blog = Blog(
+            self.tree.findtext(atom.title),
+            link,
+            self.tree.findtext(atom.subtitle),
+            self.tree.attrib.get(xml.lang, u'en'),
+            self.tags,
+            self.categories,
+            self.posts,
+            self.authors
+        )
+        self.blog.element = self.tree
+        for extension in self.extensions:
+            extension.handle_root(self.blog)
+
+    def parse_post(self, entry):
+        children = _collect_children(entry)
+
+        # parse the dates first.
+        updated = parse_iso8601(_findtext(children, atom.updated))
+        published = _findtext(children, atom.published)
+        if published is not None:
+            published = parse_iso8601(published)
+        else:
+            published = updated
+
+        # figure out tags and categories by invoking the
+        # callbacks on the extensions first.  If no extension
+        # was able to figure out what to do with it, we treat it
+        # as category.
+        tags, categories = self.parse_categories(entry, children)
+
+        link = children.get(atom.link)
+        if link is not None:
+            link = link[0].attrib.get('href')
+
+        post_parser = _pickle(children[textpress.data][0].text).get('parser', 'html')
+        if post_parser not in get_application().parsers:
+            post_parser = 'html'
+
+        post = Post(
+            _findtext(children, textpress.slug),            # slug
+            _get_text_content(children.get(atom.title)),    # title
+            link,                                           # link
+            published,                                      # pub_date
+            self.parse_author(entry, children),             # author
+            # XXX: the Post is prefixing the intro before the actual
+            # content.  This is the default Zine behavior and makes sense
+            # for Zine.  However nearly every blog works differently and
+            # treats summary completely different from content.  We should
+            # think about that.
+            _get_html_content(children.get(atom.summary)),  # intro
+            _get_html_content(children.get(atom.content)),  # body
+            tags,                                           # tags
+            categories,                                     # categories
+            parser=post_parser,
+            updated=updated,
+            uid=_findtext(children, atom.id)
+        )
+        post.record = EntryRecord(
+            _findtext(children, textpress.content_type),
+            [c.attrib['term'] for c in children.get(atom.category, ())],
+            [CommentRecord(c) for c in children.get(textpress.comment, ())]
+        )
+        post.element = None
+        if self.keep_elements:
+            post.element = entry
+        if post.record.content_type not in ('page', 'entry'):
+            post.content_type = 'entry'
+
+        # now parse the comments for the post
+        self.parse_comments(post)
+
+        for extension in self.extensions:
+            extension.postprocess_post(post)
+
+        # the comment records are no longer needed and unless an extension
+        # wants to keep the element we can release its children now.
+        post.record.comments = None
+        if not self.keep_elements:
+            entry.clear()
+
+        return post
+
+    def parse_author(self, entry, children=None):
+        """Lookup the author for the given entry.  `children` are the
+        already collected child elements of the entry, if available.
+        """
+        def _remember_author(author):
+            if author.email is not None and \
+               author.email not in self._authors_by_email:
+                self._authors_by_email[author.email] = author
+            if author.username is not None and \
+               author.username not in self._authors_by_username:
+                self._authors_by_username[author.username] = author
+
+        if children is None:
+            children = _collect_children(entry)
+        author = children[atom.author][0]
+        author_children = _collect_children(author)
+        email = _findtext(author_children, atom.email)
+        username = _findtext(author_children, atom.name)
+
+        for extension in self.extensions:
+            rv = extension.lookup_author(author, entry, username, email)
+            if rv is not None:
+                _remember_author(rv)
+                return rv
+
+        if email is not None and email in self._authors_by_email:
+            return self._authors_by_email[email]
+        if username in self._authors_by_username:
+            return self._authors_by_username[username]
+
+        author = Author(username, email)
+        _remember_author(author)
+        self.authors.append(author)
+        return author
+
+    def parse_categories(self, entry, children=None):
+        """Is passed an <entry> element and parses all <category>
+        child elements.  Returns a tuple with ``(tags, categories)``.
+        """
+        def _remember_category(category, element):
+            term = element.attrib['term']
+            if term not in self._categories_by_term:
+                self._categories_by_term[term] = category
+
+        tags = []
+        categories = []
+
+        if children is None:
+            children = _collect_children(entry)
+        for category in children.get(atom.category, ()):
+            for extension in self.extensions:
+                rv = extension.tag_or_category(category)
+                if rv is not None:
+                    if isinstance(rv, Category):
+                        categories.append(rv)
+                        _remember_category(rv, category)
+                    else:
+                        tags.append(rv)
+                    break
+            else:
+                rv = self._categories_by_term.get(category.attrib['term'])
+                if rv is None:
+                    rv = Category(category.attrib['term'],
+                                  category.attrib.get('label'))
+                    _remember_category(rv, category)
+                    self.categories.append(rv)
+                categories.append(rv)
+        return tags, categories
+
+    def parse_comments(self, post):
+        """Parse the comments for the post."""
+        for extension in self.extensions:
+            post.comments.extend(extension.parse_comments(post) or ())
+
+class FeedImportError(UserException):
+    """Raised if the system was unable to import the feed."""
+
+class TPZEAExtension(Extension):
+    """Handles Zine Atom extensions.  This extension can handle the extra
+    namespace used for ZEA feeds as generated by the Zine export.  Because
+    in a feed with Zine extensions the rules are pretty strict we don't
+    look up authors, tags or categories on the parser object like we should
+    but have a mapping for those directly on the extension.
+    """
+
+    feed_types = frozenset(['atom'])
+
+    #: works on the entry records, the elements can be dropped
+    needs_element = False
+
+    def __init__(self, app, parser, root):
+        Extension.__init__(self, app, parser, root)
+        self._authors = {}
+        self._tags = {}
+        self._categories = {}
+        self._users = {}
+        dependencies = root.find(textpress.dependencies)
+        if dependencies is not None:
+            for element in dependencies.iterchildren(textpress.user):
+                self._users[element.attrib[textpress.dependency]] = element
+
+    def _parse_config(self, element):
+        result = {}
+        if element is not None:
+            for element in element.findall(textpress.item):
+                result[element.attrib['key']] = element.text
+        return result
+
+    def _get_author(self, dependency):
+        author = self._authors.get(dependency)
+        if author is None:
+            element = self._users[dependency]
+            children = _collect_children(element)
+            author = Author(
+                _findtext(children, textpress.username),
+                _findtext(children, textpress.email),
+                _findtext(children, textpress.real_name),
+                _findtext(children, textpress.description),
+                _findtext(children, textpress.www),
+                _findtext(children, textpress.pw_hash),
+                int(_findtext(children, textpress.role) or 0)==4,
+                _pickle(_findtext(children, textpress.extra))
+            )
+            for privilege in children.get(textpress.privilege, ()):
+                p = self.app.privileges.get(privilege.text)
+                if p is not None:
+                    author.privileges.add(p)
+            self._authors[dependency] = author
+            self.parser.authors.append(author)
+        return author
+
+    def _parse_tag(self, element):
+        term = element.attrib['term']
+        if term not in self._tags:
+            self._tags[term] = Tag(term, element.attrib.get('label'))
+        return self._tags[term]
+
+    def _parse_category(self, element):
+        term = element.attrib['term']
+        if term not in self._categories:
+            self._categories[term] = Category(
+                term, element.attrib.get('label'),
+                element.findtext(textpress.description)
+            )
+        return self._categories[term]
+
+    def handle_root(self, blog):
+        blog.configuration.update(self._parse_config(
+            blog.element.find(textpress.configuration)))
+
+    def _record(self, post):
+        """Return the entry record of `post`.  Posts from Zine's own feed
+        importer only have the element, the record is created from it.
+        """
+        record = getattr(post, 'record', None)
+        if record is None and getattr(post, 'element', None) is not None:
+            children = _collect_children(post.element)
+            record = EntryRecord(
+                _findtext(children, textpress.content_type),
+                [c.attrib['term'] for c in children.get(atom.category, ())],
+                [CommentRecord(c) for c in children.get(textpress.comment, ())]
+            )
+        return record
+
+    def postprocess_post(self, post):
+        record = self._record(post)
+        if record is None:
+            return
+        content_type = record.content_type
+        if content_type is not None:
+            post.content_type = content_type
+
+    def lookup_author(self, author, entry, username, email):
+        dependency = author.attrib.get(textpress.dependency)
+        if dependency is not None:
+            return self._get_author(dependency)
+
+    def tag_or_category(self, element):
+        scheme = element.attrib.get('scheme')
+        if scheme == TEXTPRESS_TAG_URI:
+            return self._parse_tag(element)
+        elif scheme == TEXTPRESS_CATEGORY_URI:
+            return self._parse_category(element)
+
+    def parse_comments(self, post):
+        entry = self._record(post)
+        if entry is None:
+            return []
+        comments = {}
+        unresolved_parents = {}
+
+        for record in entry.comments:
+            if record.dependency is not None:
+                author = self._get_author(record.dependency)
+                email = www = None
+            else:
+                author, email, www = record.author, record.email, record.www
+
+            body = u''
+            comment_parser = 'html'
+            if record.data:
+                pickled = _pickle(record.data)
+                body = pickled.get('raw_body', u'')
+
+                comment_parser = pickled.get('parser', 'html')
+                if comment_parser not in get_application().parsers:
+                    comment_parser = 'html'
+
+            comment = Comment(
+                author, body, email, www, None,
+                parse_iso8601(record.published),
+                record.submitter_ip, comment_parser,
+                _to_bool(record.is_pingback),
+                int(record.status),
+                record.blocked_msg,
+                _parser_data(record.parser_data)
+            )
+            comments[record.id] = comment
+            if record.parent is not None:
+                unresolved_parents[comment] = record.parent
+
+        for comment, parent_id in unresolved_parents.iteritems():
+            comment.parent = comments[parent_id]
+
+        return comments.values()
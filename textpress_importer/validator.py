@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    textpress_importer.validator
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Structural validation of TPXA files.  The file is streamed through the
+    parser and every entry is checked and thrown away right afterwards, so
+    validating an export is a lot cheaper than a real import and the memory
+    usage does not depend on the size of the file.  No Zine objects are
+    created and nothing is added to the import queue.
+
+    The module only depends on lxml and the standard library, so it can
+    also be used from the command line on a machine without Zine::
+
+        python validator.py blog_export.tpxa [more.tpxa ...]
+
+    :copyright: Copyright 2009 by Pedro Algarvio.
+    :license: GNU GPL.
+"""
+import re
+from cPickle import loads
+from lxml import etree
+from integrity import ChecksumReader, IntegrityError, MappedFile
+
+ATOM_NS = 'http://www.w3.org/2005/Atom'
+TEXTPRESS_NS = 'http://textpress.pocoo.org/'
+TEXTPRESS_TAG_URI = TEXTPRESS_NS + '#tag-scheme'
+
+#: stop collecting errors after that many
+MAX_ERRORS = 100
+
+_iso8601_re = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}(:\d{2}(\.\d+)?)?'
+                         r'(Z|[+-]\d{2}:?\d{2})?$')
+
+
+def _atom(tag):
+    return '{%s}%s' % (ATOM_NS, tag)
+
+def _tp(tag):
+    return '{%s}%s' % (TEXTPRESS_NS, tag)
+
+
+class ValidationReport(object):
+    """The result of a validation run."""
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.errors = []
+        self.entries = 0
+        self.pages = 0
+        self.comments = 0
+        self.authors = 0
+        self.tags = set()
+        self.categories = set()
+        self.payload_bytes = 0
+
+    @property
+    def valid(self):
+        return not self.errors
+
+    @property
+    def estimated_objects(self):
+        """The number of objects a real import would create.  That's the
+        best estimate for the import cost that can be given without
+        actually importing.
+        """
+        return self.entries + self.comments + self.authors + \
+               len(self.tags) + len(self.categories)
+
+    def error(self, message, entry=None):
+        if len(self.errors) >= MAX_ERRORS:
+            return
+        if entry is not None:
+            message = 'entry %s: %s' % (entry, message)
+        self.errors.append(message)
+
+    def summary(self):
+        """Return the report as a list of lines."""
+        rv = [
+            'entries:           %d (%d pages)' % (self.entries, self.pages),
+            'comments:          %d' % self.comments,
+            'authors:           %d' % self.authors,
+            'tags:              %d' % len(self.tags),
+            'categories:        %d' % len(self.categories),
+            'payload bytes:     %d' % self.payload_bytes,
+            'objects to create: %d' % self.estimated_objects
+        ]
+        if self.valid:
+            rv.append('no problems found')
+        else:
+            rv.append('%d problem(s) found:' % len(self.errors))
+            rv.extend('  ' + error for error in self.errors)
+        return rv
+
+
+class _Validator(object):
+
+    def __init__(self, report):
+        self.report = report
+        self.user_ids = set()
+        self.referenced_users = {}
+        self.trailer = None
+
+    def check_payload(self, value, where, entry):
+        if not value:
+            self.report.error('missing %s payload' % where, entry)
+            return
+        try:
+            data = value.decode('base64')
+            loads(data)
+        except Exception, e:
+            self.report.error('undecodable %s payload (%s)' % (where, e), entry)
+        else:
+            self.report.payload_bytes += len(data)
+
+    def check_date(self, value, what, entry):
+        if value is None:
+            self.report.error('missing %s' % what, entry)
+        elif not _iso8601_re.match(value.strip()):
+            self.report.error('invalid %s %r' % (what, value), entry)
+
+    def reference_user(self, dependency, entry):
+        if dependency is not None:
+            self.referenced_users.setdefault(dependency, entry)
+
+    def check_entry(self, element):
+        report = self.report
+        report.entries += 1
+        entry = element.findtext(_atom('id')) or '#%d' % report.entries
+        children = {}
+        for child in element:
+            children.setdefault(child.tag, []).append(child)
+
+        for tag in _atom('id'), _atom('title'), _atom('author'), \
+                   _tp('slug'), _tp('data'):
+            if tag not in children:
+                report.error('missing required element %s' % tag, entry)
+        self.check_date(element.findtext(_atom('updated')), 'updated date',
+                        entry)
+
+        for author in children.get(_atom('author'), ()):
+            self.reference_user(author.attrib.get(_tp('dependency')), entry)
+
+        for data in children.get(_tp('data'), ())[:1]:
+            self.check_payload(data.text, 'entry', entry)
+
+        content_type = element.findtext(_tp('content_type'))
+        if content_type == 'page':
+            report.pages += 1
+        elif content_type not in (None, 'entry'):
+            report.error('unknown content type %r' % content_type, entry)
+
+        for category in children.get(_atom('category'), ()):
+            term = category.attrib.get('term')
+            if not term:
+                report.error('category without term', entry)
+            elif category.attrib.get('scheme') == TEXTPRESS_TAG_URI:
+                report.tags.add(term)
+            else:
+                report.categories.add(term)
+
+        self.check_comments(children.get(_tp('comment'), ()), entry)
+
+    def check_comments(self, comments, entry):
+        report = self.report
+        ids = set()
+        parents = []
+        for comment in comments:
+            report.comments += 1
+            comment_id = comment.findtext(_tp('id'))
+            try:
+                ids.add(int(comment_id))
+            except (TypeError, ValueError):
+                report.error('comment with invalid id %r' % comment_id, entry)
+                continue
+            where = 'comment %s' % comment_id
+            author = comment.find(_tp('author'))
+            if author is None:
+                report.error('%s has no author' % where, entry)
+            else:
+                self.reference_user(author.attrib.get(_tp('dependency')) or
+                                    author.attrib.get('dependency'), entry)
+            self.check_date(comment.findtext(_tp('published')),
+                            '%s date' % where, entry)
+            if comment.findtext(_tp('is_pingback')) not in ('yes', 'no'):
+                report.error('%s has an invalid pingback flag' % where, entry)
+            try:
+                int(comment.findtext(_tp('status')))
+            except (TypeError, ValueError):
+                report.error('%s has an invalid status' % where, entry)
+            self.check_payload(comment.findtext(_tp('data')), where, entry)
+            parent = comment.findtext(_tp('parent'))
+            if parent:
+                parents.append((comment_id, parent))
+
+        for comment_id, parent in parents:
+            try:
+                parent = int(parent)
+            except ValueError:
+                parent = None
+            if parent not in ids:
+                report.error('comment %s references unknown parent comment %s'
+                             % (comment_id, parent), entry)
+
+    def check_dependencies(self, element):
+        for user in element.iterchildren(_tp('user')):
+            dependency = user.attrib.get(_tp('dependency'))
+            if dependency is None:
+                self.report.error('user dependency without id')
+                continue
+            self.user_ids.add(dependency)
+            if not user.findtext(_tp('username')):
+                self.report.error('user dependency %s has no username' %
+                                  dependency)
+        self.report.authors = len(self.user_ids)
+
+    def finish(self):
+        for dependency, entry in sorted(self.referenced_users.iteritems()):
+            if dependency not in self.user_ids:
+                self.report.error('unknown author dependency %s' % dependency,
+                                  entry)
+        if self.trailer is not None and self.trailer != self.report.entries:
+            self.report.error('trailer announces %d entries but %d were found'
+                              % (self.trailer, self.report.entries))
+
+
+def validate_feed(fd, checksum=None, filename=None):
+    """Validate the TPXA file from `fd` and return a
+    :class:`ValidationReport`.  If `checksum` is given it's verified on the
+    way.  `fd` can also be the name of a local file, which is read from a
+    memory mapping if it has to be hashed and by lxml itself otherwise.
+    """
+    if checksum and isinstance(fd, basestring):
+        mapped = MappedFile(fd)
+        try:
+            return validate_feed(mapped, checksum, filename)
+        finally:
+            mapped.close()
+
+    report = ValidationReport(filename)
+    validator = _Validator(report)
+    if checksum:
+        try:
+            fd = ChecksumReader(fd, checksum)
+        except IntegrityError, e:
+            report.error(str(e))
+            return report
+
+    root = None
+    try:
+        for event, element in etree.iterparse(fd, events=('start', 'end')):
+            if root is None:
+                root = element
+                if element.tag != _atom('feed'):
+                    report.error('root element is %s, not an Atom feed' %
+                                 element.tag)
+                    return report
+                if TEXTPRESS_NS not in element.nsmap.values():
+                    report.error('the TextPress namespace is not declared')
+                continue
+            if event != 'end' or element.getparent() is not root:
+                continue
+
+            if element.tag == _atom('entry'):
+                validator.check_entry(element)
+            elif element.tag == _tp('dependencies'):
+                validator.check_dependencies(element)
+            elif element.tag == _tp('trailer'):
+                try:
+                    validator.trailer = int(element.attrib['entries'])
+                except (KeyError, ValueError):
+                    report.error('invalid trailer')
+            else:
+                continue
+
+            # we are done with this element, free it and its siblings
+            element.clear()
+            while element.getprevious() is not None:
+                del root[0]
+    except IntegrityError, e:
+        report.error(str(e))
+        return report
+    except etree.XMLSyntaxError, e:
+        report.error('XML syntax error: %s' % e)
+        return report
+
+    if root is None:
+        report.error('empty file')
+        return report
+    validator.finish()
+    return report
+
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options] file.tpxa [file.tpxa ...]')
+    parser.add_option(
+        '--checksum', '-c', default=False, action='store_true',
+        help="Verify the checksum from the '.sha256' file next to each "
+             "export. (%default)")
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("you need to pass at least one export file")
+
+    failed = False
+    for filename in args:
+        checksum = None
+        if options.checksum:
+            try:
+                checksum = open(filename + '.sha256').read()
+            except IOError, e:
+                print "%s: cannot read checksum: %s" % (filename, e)
+                failed = True
+                continue
+        report = validate_feed(filename, checksum, filename)
+        print filename
+        for line in report.summary():
+            print '  ' + line
+        failed = failed or not report.valid
+
+    raise SystemExit(failed and 1 or 0)
+
+
+if __name__ == '__main__':
+    main()